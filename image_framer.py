@@ -1,6 +1,73 @@
-from PIL import Image, ImageDraw, ImageFont, ExifTags
-import piexif
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from PIL import Image, ImageDraw, ImageFont, features
+import pyexiv2
 import os
+import warnings
+
+JPEG_SOI = b"\xff\xd8\xff"
+ORIENTATION_TAG = "Exif.Image.Orientation"
+ORIENTATION_TRANSPOSE = {
+    3: Image.Transpose.ROTATE_180,
+    6: Image.Transpose.ROTATE_270,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# exiv2 logs a warning for every quirk in maker notes; keep the output quiet
+pyexiv2.set_log_level(4)
+
+
+def _check_libjpeg_turbo():
+    # Only checked from the parent process, so pool workers re-importing
+    # this module do not repeat the warning
+    if not features.check_feature("libjpeg_turbo"):
+        warnings.warn(
+            "Pillow was built without libjpeg-turbo, JPEG decoding will be slower",
+            RuntimeWarning,
+        )
+
+
+def _scale(value, ratio):
+    # For sizes that must stay at least one pixel (fonts, image dimensions)
+    return max(1, round(value * ratio))
+
+
+def _resize(img, size, scale_ratio):
+    # For large downscales, box-average down to twice the target first so
+    # LANCZOS only has a 2x shrink left to do
+    if scale_ratio < 0.5:
+        img = img.resize((size[0] * 2, size[1] * 2), Image.Resampling.BOX)
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+
+def _read_exif(image_path):
+    with pyexiv2.Image(image_path) as metadata:
+        return metadata.read_exif()
+
+
+def _parse_rational(value):
+    numerator, _, denominator = value.partition("/")
+    return int(numerator), int(denominator or 1)
+
+
+@lru_cache(maxsize=16)
+def _load_font(path, size):
+    return ImageFont.truetype(path, size=size)
+
+
+# Consecutive shots usually share the same camera and exposure settings, so
+# cache each rendered caption line as a transparent sticker
+@lru_cache(maxsize=128)
+def _render_line(text, font, color):
+    _, _, right, bottom = font.getbbox(text)
+    line_img = Image.new("RGBA", (max(right, 1), max(bottom, 1)), (0, 0, 0, 0))
+    ImageDraw.Draw(line_img).text((0, 0), text, fill=color, font=font)
+    return line_img
+
+
+def _paste_line(image, position, line_img):
+    # The sticker is shared through the cache, so it is only ever read here
+    image.paste(line_img, position, line_img)
 
 
 def annotate_image(
@@ -17,103 +84,140 @@ def annotate_image(
     text_padding=150,  # Spacing between the image and the text
     long_edge_size=2000,  # Resize long edge to this dimension
 ):
+    # if the image is not jpeg or jpg, do not annotate
+    with open(image_path, "rb") as image_file:
+        if image_file.read(3) != JPEG_SOI:
+            print("ERROR: Image is not JPEG or JPG")
+            return
+
     img = Image.open(image_path)
 
-    # if the image is not jpeg or jpg, do not annotate
-    if img.format != "JPEG" and img.format != "JPG":
-        print("ERROR: Image is not JPEG or JPG")
-        return
+    # Let libjpeg decode at a reduced scale when the source is much larger
+    # than the output, then scale the frame geometry to match
+    original_width = img.width
+    requested_font_size = font_size
+    img.draft("RGB", (long_edge_size, long_edge_size))
+    if img.width != original_width:
+        draft_ratio = img.width / original_width
+        border_width = round(border_width * draft_ratio)
+        font_size = _scale(font_size, draft_ratio)
+        line_spacing = round(line_spacing * draft_ratio)
+        text_padding = round(text_padding * draft_ratio)
+
+    # Read all the EXIF tags we need in a single pass
+    exif_data = _read_exif(image_path)
 
     # Handle rotations when needed
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == "Orientation":
-                break
-        exif_data = img._getexif()
-        if exif_data and orientation in exif_data:
-            orientation_value = exif_data[orientation]
-            if orientation_value == 3:
-                img = img.rotate(180, expand=True)
-            elif orientation_value == 6:
-                img = img.rotate(270, expand=True)
-            elif orientation_value == 8:
-                img = img.rotate(90, expand=True)
+        orientation_value = int(exif_data.get(ORIENTATION_TAG, 1))
+        if orientation_value in ORIENTATION_TRANSPOSE:
+            img = img.transpose(ORIENTATION_TRANSPOSE[orientation_value])
     except Exception as e:
         print(f"Error handling EXIF orientation: {e}")
 
     # Extract metadata
-    exif_data = piexif.load(img.info["exif"])
-    model = exif_data["0th"][piexif.ImageIFD.Model].decode("utf-8")
-    iso = exif_data["Exif"][piexif.ExifIFD.ISOSpeedRatings]
-    shutter_speed = exif_data["Exif"][piexif.ExifIFD.ExposureTime]
-    focal_length = exif_data["Exif"][piexif.ExifIFD.FocalLength]
-    aperture = exif_data["Exif"][piexif.ExifIFD.FNumber]
+    model = exif_data["Exif.Image.Model"]
+    iso = exif_data["Exif.Photo.ISOSpeedRatings"]
+    shutter_speed = _parse_rational(exif_data["Exif.Photo.ExposureTime"])
+    focal_length = _parse_rational(exif_data["Exif.Photo.FocalLength"])
+    aperture = _parse_rational(exif_data["Exif.Photo.FNumber"])
 
-    # Frame math
-    new_width = img.width + 2 * border_width
-    framed_height = img.height + 2 * border_width + text_padding
-    framed_image = Image.new("RGB", (new_width, framed_height), frame_color)
-    framed_image.paste(img, (border_width, border_width))
+    # Resize the source first so the frame and text are drawn at output
+    # resolution. The text height is estimated by scaling the metrics of the
+    # requested font size linearly, so apart from that size, which every
+    # image shares, only the sizes that get drawn are loaded
+    iw, ih = img.size
+    line_height = (
+        sum(_load_font(font_path, requested_font_size).getmetrics())
+        * font_size
+        / requested_font_size
+    )
+    long_edge = max(
+        iw + 2 * border_width,
+        ih + 2 * border_width + 2 * text_padding + 2 * line_height + line_spacing,
+    )
+    scale_ratio = long_edge_size / long_edge
+    if scale_ratio < 1.0:
+        border_width = round(border_width * scale_ratio)
+        font_size = _scale(font_size, scale_ratio)
+        line_spacing = round(line_spacing * scale_ratio)
+        text_padding = round(text_padding * scale_ratio)
+
+    regular_font = _load_font(font_path, font_size)
+    bold_font = _load_font(bold_font_path, font_size)
+    line_height = sum(regular_font.getmetrics())
+    total_text_height = 2 * line_height + line_spacing
 
-    regular_font = ImageFont.truetype(font_path, size=font_size)
-    bold_font = ImageFont.truetype(bold_font_path, size=font_size)
+    # Font metrics do not scale exactly and each dimension is rounded on its
+    # own, so give the photo exactly the room the frame leaves on the long edge
+    max_iw = long_edge_size - 2 * border_width
+    max_ih = long_edge_size - 2 * border_width - 2 * text_padding - total_text_height
+    fit_ratio = min(max_iw / iw, max_ih / ih)
+    if fit_ratio < 1.0:
+        iw = max(1, min(round(iw * fit_ratio), max_iw))
+        ih = max(1, min(round(ih * fit_ratio), max_ih))
+        img = _resize(img, (iw, ih), fit_ratio)
 
     line1_part1 = "Shot on "
     line1_part2 = model  # Bold part
-    line2 = f"{(focal_length[0] // focal_length[1])}mm   f/{aperture[0]/aperture[1]:.1f}   {shutter_speed[0]}/{shutter_speed[1]}s   ISO{iso}"
+    focal_mm = focal_length[0] // focal_length[1]
+    f_num = aperture[0] / aperture[1]
+    line2 = f"{focal_mm}mm   f/{f_num:.1f}   {shutter_speed[0]}/{shutter_speed[1]}s   ISO{iso}"
 
     # Calculate dimensions
-    draw = ImageDraw.Draw(framed_image)
-    line1_part1_width = draw.textbbox((0, 0), line1_part1, font=regular_font)[2]
-    line1_part2_width = draw.textbbox((0, 0), line1_part2, font=bold_font)[2]
-    line2_width = draw.textbbox((0, 0), line2, font=regular_font)[2]
-
-    total_text_height = (
-        draw.textbbox((0, 0), line1_part1, font=regular_font)[3]
-        + draw.textbbox((0, 0), line2, font=regular_font)[3]
-        + line_spacing
-    )
+    line1_part1_width = int(regular_font.getlength(line1_part1))
+    line1_part2_width = int(bold_font.getlength(line1_part2))
+    line2_width = int(regular_font.getlength(line2))
 
-    # Height of the frame calculations
+    # Frame math
+    new_width = iw + 2 * border_width
+    framed_height = ih + 2 * border_width + text_padding
     new_height = framed_height + total_text_height + text_padding
     framed_image_with_text = Image.new("RGB", (new_width, new_height), frame_color)
-    framed_image_with_text.paste(framed_image, (0, 0))
-
-    draw = ImageDraw.Draw(framed_image_with_text)
+    framed_image_with_text.paste(img, (border_width, border_width))
 
     # Makes sure the text is centered bellow the image
-    text_start_y = img.height + border_width + text_padding
+    text_start_y = ih + border_width + text_padding
 
     # Draw the first line
     line1_x = (new_width - (line1_part1_width + line1_part2_width)) // 2
-    draw.text((line1_x, text_start_y), line1_part1, fill=text_color, font=regular_font)
-    draw.text(
-        (line1_x + line1_part1_width, text_start_y),
-        line1_part2,
-        fill=text_color,
-        font=bold_font,
+    _paste_line(
+        framed_image_with_text,
+        (line1_x, text_start_y),
+        _render_line(line1_part1, regular_font, text_color),
     )
-    text_start_y += (
-        draw.textbbox((0, 0), line1_part1, font=regular_font)[3] + line_spacing
+    _paste_line(
+        framed_image_with_text,
+        (line1_x + line1_part1_width, text_start_y),
+        _render_line(line1_part2, bold_font, text_color),
     )
+    text_start_y += line_height + line_spacing
 
     # Draw the second line
     line2_x = (new_width - line2_width) // 2
-    draw.text((line2_x, text_start_y), line2, fill=second_line_color, font=regular_font)
-
-    # Resize long edge
-    long_edge = max(framed_image_with_text.width, framed_image_with_text.height)
-    scale_ratio = long_edge_size / long_edge
-    new_size = (
-        int(framed_image_with_text.width * scale_ratio),
-        int(framed_image_with_text.height * scale_ratio),
+    _paste_line(
+        framed_image_with_text,
+        (line2_x, text_start_y),
+        _render_line(line2, regular_font, second_line_color),
     )
-    resized_image = framed_image_with_text.resize(new_size, Image.Resampling.LANCZOS)
 
-    resized_image.save(output_path)
+    framed_image_with_text.save(
+        output_path,
+        "JPEG",
+        quality=90,
+        subsampling="4:2:0",
+        optimize=False,
+        progressive=False,
+    )
     print(f"Framed image saved to {output_path}")
 
 
+def _annotate_file(file_name, folder_path, **kwargs):
+    input_path = os.path.join(folder_path, file_name)
+    output_path = os.path.join(folder_path, f"{os.path.splitext(file_name)[0]}F.jpg")
+    annotate_image(input_path, output_path, **kwargs)
+
+
 def annotate_images(
     folder_path,
     border_width=100,
@@ -127,40 +231,44 @@ def annotate_images(
     text_padding=150,
     long_edge_size=2000,
 ):
+    _check_libjpeg_turbo()
+
     try:
+        file_names = []
         for file_name in os.listdir(folder_path):
-            input_path = os.path.join(folder_path, file_name)
-
             if not (
                 file_name.lower().endswith(".jpg")
                 or file_name.lower().endswith(".jpeg")
             ):
                 print(f"Skipping non-JPEG file: {file_name}")
                 continue
+            file_names.append(file_name)
 
-            output_path = os.path.join(
-                folder_path, f"{os.path.splitext(file_name)[0]}F.jpg"
-            )
-
-            annotate_image(
-                input_path,
-                output_path,
-                border_width=border_width,
-                frame_color=frame_color,
-                text_color=text_color,
-                second_line_color=second_line_color,
-                font_path=font_path,
-                bold_font_path=bold_font_path,
-                font_size=font_size,
-                line_spacing=line_spacing,
-                text_padding=text_padding,
-                long_edge_size=long_edge_size,
-            )
+        # Each image is independent, so spread them across all cores. Fonts
+        # are not preloaded here since their size depends on each image's
+        # draft scale; _load_font caches them per worker process instead
+        worker = partial(
+            _annotate_file,
+            folder_path=folder_path,
+            border_width=border_width,
+            frame_color=frame_color,
+            text_color=text_color,
+            second_line_color=second_line_color,
+            font_path=font_path,
+            bold_font_path=bold_font_path,
+            font_size=font_size,
+            line_spacing=line_spacing,
+            text_padding=text_padding,
+            long_edge_size=long_edge_size,
+        )
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(worker, file_names))
     except Exception as e:
         print(f"Error processing folder {folder_path}: {e}")
 
 
 if __name__ == "__main__":
+    _check_libjpeg_turbo()
     annotate_image(
         image_path="./t1.jpg",
         output_path="./t1F.jpg",